@@ -2,7 +2,7 @@ import json
 import logging
 
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, hstack
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,6 +31,21 @@ def load_translation_dict_from_icd10(
     return translation_dict_icd10
 
 
+def _unique_inverse(values):
+    """
+    Dict-based equivalent of np.unique(values, return_inverse=True) for arrays
+    of code strings. np.unique sorts, which costs O(N logN) Python string
+    comparisons on object arrays; a single hashing pass is O(N) and returns the
+    value-to-ID dictionary directly, in first-occurrence order.
+    returns a tuple (id_dict mapping value to ID, 1d int32 np.array of inverse indices)
+    """
+    id_dict = {}
+    inverse = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        inverse[i] = id_dict.setdefault(value, len(id_dict))
+    return id_dict, inverse
+
+
 def setup_matrices_by_layer(
     code_ids, translation_dict, max_layer=1, include_duplicates=False
 ):
@@ -47,46 +62,57 @@ def setup_matrices_by_layer(
     matrices = []  # tranlsation matrices per layer
     layer_id_dicts = []  # id-to-code dictionary per layer
 
+    codes = list(code_ids)
+    codes_arr = np.array(codes, dtype=object)
+    all_rows = np.fromiter(
+        (code_ids[code] for code in codes), dtype=np.int32, count=len(codes)
+    )  # row number per code (current code)
+    # built with an explicit shape so an empty code set still yields a
+    # (0, max_layer) array that supports the per-layer column slicing below
+    parents_by_layer = np.empty((len(codes), max_layer), dtype=object)
+    for i, code in enumerate(codes):
+        parents_by_layer[i] = translation_dict[code]["parents"][:max_layer]
+    # (n_codes, max_layer) ancestors - walks the nested dicts only once
+
     for layer in range(max_layer):
-        rows, cols, vals = [], [], []  # setup for a sparse matrix
-        layer_codeset = (
-            set()
-        )  # codeset for ancestors - in order to remove duplicates for layer representation
-        for code in code_ids:
-            candidate = translation_dict[code]["parents"][layer]
-            if (
-                layer == max_layer - 1
-                or candidate != translation_dict[code]["parents"][layer + 1]
-                or include_duplicates
-            ):
-                layer_codeset.add(
-                    translation_dict[code]["parents"][layer]
-                )  # collection of relevant ancestors in the layer
-
-        layer_ranges = list(range(len(layer_codeset)))
-        layer_id_dict = dict(
-            zip(list(layer_codeset), layer_ranges)
-        )  # association of IDs with relevant acestors in the layer
-
-        for code in code_ids:
-            ancestor = translation_dict[code]["parents"][layer]
-            if ancestor in layer_codeset:
-                rows.append(code_ids[code])  # row number (current code)
-                cols.append(layer_id_dict[ancestor])  # col number (ancestor)
-                if (
-                    include_duplicates or layer == max_layer - 2
-                ):  # if duplicates are allowed or the next layer is the final layer, create an edge
-                    vals.append(1)
-                else:  # otherwise observe the ancestor of the ancestor - if this matches the current code, do not create an edge. Otherwise create an edge.
-                    assert (
-                        ancestor in translation_dict
-                    ), f"Ancestor {ancestor} of code {code} not found."
-                    double_ancestor = translation_dict[ancestor]["parents"][layer + 1]
-                    duplicate_ancestor = double_ancestor == code
-                    vals.append(not (duplicate_ancestor) * 1)
+        parents = parents_by_layer[:, layer]  # ancestor in the layer per code
+
+        # codeset for ancestors - in order to remove duplicates for layer representation
+        if include_duplicates or layer == max_layer - 1:
+            kept = np.ones(len(codes), dtype=bool)
+        else:
+            kept = parents != parents_by_layer[:, layer + 1]
+        layer_codeset = set(parents[kept].tolist())  # relevant ancestors in the layer
+
+        # entries exist for every code whose ancestor is relevant in the layer
+        entries = np.fromiter(
+            (parent in layer_codeset for parent in parents),
+            dtype=bool,
+            count=len(parents),
+        )
+        layer_id_dict, cols = _unique_inverse(
+            parents[entries]
+        )  # association of IDs with relevant acestors in the layer / col number per entry
+        rows = all_rows[entries]
+
+        if (
+            include_duplicates or layer == max_layer - 2
+        ):  # if duplicates are allowed or the next layer is the final layer, create an edge
+            vals = np.ones(len(rows), dtype=np.int8)
+        else:  # otherwise observe the ancestor of the ancestor - if this matches the current code, do not create an edge. Otherwise create an edge.
+            for ancestor in layer_id_dict:
+                assert ancestor in translation_dict, f"Ancestor {ancestor} not found."
+            double_ancestors = np.array(
+                [
+                    translation_dict[ancestor]["parents"][layer + 1]
+                    for ancestor in parents[entries]
+                ],
+                dtype=object,
+            )
+            vals = (double_ancestors != codes_arr[entries]).astype(np.int8)
 
         matrix = csr_matrix(
-            (vals, (rows, cols)), shape=((len(code_ids)), (len(set(cols))))
+            (vals, (rows, cols)), shape=((len(code_ids)), (len(layer_id_dict)))
         )  # set up the sparse matrix
 
         matrices.append(matrix)  # append the matrix for this layer
@@ -108,14 +134,15 @@ def low_level_filter(code_ids, translation_dict):
     layer_ranges = list(range(len(layer_codeset)))
     layer_id_dict = dict(zip(list(layer_codeset), layer_ranges))
     for code in code_ids:
-        rows.append(code_ids[code])  # row number (current code)
         if code in layer_codeset:
+            rows.append(code_ids[code])  # row number (current code)
             cols.append(layer_id_dict[code])  # col number (ancestor)
             vals.append(1)
-        else:
-            cols.append(0)
-            vals.append(0)
-    matrix = csr_matrix((vals, (rows, cols)), shape=((len(rows)), (len(set(cols)))))
+        # codes outside the codeset are masked by structural zeros - no entry is stored
+    matrix = csr_matrix(
+        (np.asarray(vals, dtype=np.int8), (rows, cols)),
+        shape=((len(code_ids)), (len(layer_codeset))),
+    )
     return matrix, layer_id_dict
 
 
@@ -129,31 +156,82 @@ def combined_matrix_setup(
     return [low_level_matrix] + matrices, [low_level_id_dict] + level_id_dicts
 
 
-def hierarchical_eval_setup(preds, golds, layer_matrices, max_onto_layers):
+def hierarchical_eval_setup(
+    preds, golds, layer_matrices, max_onto_layers, binarize=False
+):
     """
     inputs:
       preds - a numpy array, a matrix of predictions
       golds - a numpy array, a matrix of true labels
       layer_matrices - a list of numpy arrays translating the leaf nodes into layers of the ontology
       max_onto_layers - an integer describing the maximum layer (from the bottom up) within the ontology to be evaluated on
+      binarize - boolean, default = False; return the combined representations as
+                 binarised (0/1 int8) CSR matrices instead of dense count matrices.
+                 Upper-layer blocks are mostly empty for long-tail code sets, so
+                 the set-based reports can then run in O(nnz) sparse arithmetic.
     """
-
-    combined_preds = []
-    combined_golds = []
+    if binarize:
+        # bool CSR matrices subtract elementwise as xor, which breaks the
+        # fp/fn helpers in multi_level_eval - store the binarised values as
+        # 0/1 int8 instead (same nnz, ordinary integer arithmetic)
+        sparse_preds = csr_matrix(preds)
+        sparse_golds = csr_matrix(golds)
+        combined_preds = (
+            hstack(
+                [sparse_preds @ layer_matrices[i] for i in range(max_onto_layers + 1)],
+                format="csr",
+            )
+            .astype(bool)
+            .astype(np.int8)
+        )
+        combined_golds = (
+            hstack(
+                [sparse_golds @ layer_matrices[i] for i in range(max_onto_layers + 1)],
+                format="csr",
+            )
+            .astype(bool)
+            .astype(np.int8)
+        )
+        return combined_preds, combined_golds
+
+    # integer counts are stored as int16 to halve the memory traffic of the
+    # downstream tp/fp/fn reductions - the per-layer bound below makes sure the
+    # translated counts (sums over an ancestor's children) actually fit. Float
+    # inputs keep their own dtype, as an integer buffer would silently
+    # truncate them.
+    integer_counts = np.issubdtype(preds.dtype, np.integer) and np.issubdtype(
+        golds.dtype, np.integer
+    )
+    if integer_counts:
+        combined_dtype = np.int16
+        max_leaf_count = max(np.max(preds), np.max(golds))
+    else:
+        combined_dtype = np.result_type(preds, golds)
+
+    # the final width is known from the layer matrices, so the combined output
+    # is preallocated and each layer is written into its slice - no per-layer
+    # block list and no full-size concatenation copy
+    n_docs = preds.shape[0]
+    layer_widths = [layer_matrices[i].shape[1] for i in range(max_onto_layers + 1)]
+    combined_preds = np.empty((n_docs, sum(layer_widths)), dtype=combined_dtype)
+    combined_golds = np.empty_like(combined_preds)
 
     # handling further layers
+    offset = 0
     for i in range(max_onto_layers + 1):
         translation_matrix = layer_matrices[i]  # layer matrix retrieval
-        translated_preds, translated_golds = (
-            preds * translation_matrix,
-            golds * translation_matrix,
-        )  # translation from flat predictions into the layer
-        combined_preds.append(translated_preds)
-        combined_golds.append(translated_golds)
-
-    # concatenation between layers for predictions and true labels respectively
-    combined_preds = np.concatenate(combined_preds, 1)
-    combined_golds = np.concatenate(combined_golds, 1)
+        stop = offset + layer_widths[i]
+        if integer_counts:
+            # the largest translated count is bounded by the largest leaf
+            # count times the layer's biggest fan-in (column sum)
+            fan_in = int(translation_matrix.sum(axis=0).max()) if layer_widths[i] else 0
+            assert (
+                max_leaf_count * fan_in <= np.iinfo(np.int16).max
+            ), f"translated counts of layer {i} exceed int16"
+        # translation from flat predictions into the layer, dispatched to sparse matmul
+        combined_preds[:, offset:stop] = preds @ translation_matrix
+        combined_golds[:, offset:stop] = golds @ translation_matrix
+        offset = stop
 
     return combined_preds, combined_golds
 
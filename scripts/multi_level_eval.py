@@ -1,402 +1,680 @@
-import logging
-
-import numpy as np
-import pandas as pd
-from scipy.sparse import csr_matrix
-
-from .evaluation_setup import combined_matrix_setup, hierarchical_eval_setup
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-
-
-def tp_matrix_mul(pred, gold, axes):
-    """
-    Calculation of True Positives in non-binary setting.
-    On the ancestor levels leaf-level mismatches do not matter. If an ancestor-prediction has an ancestor-gold counterpart,
-    it is considered a TP. Hence, the overall TP for an ancestor is the minimum of the count of the predicted ancestor
-    and the count of the gold standard ancestor.
-
-    inputs
-      pred: numpy array of predictions
-      gold: numpy array of true labels
-      axes: axes on which summing is to be performed (all dimensions for overall TP)
-    returns integer if axes represent all dimensions, a vector of integers otherwise
-    """
-    return np.sum(np.minimum(pred, gold), axis=axes)
-
-
-def fp_matrix_mul(pred, gold, axes):
-    """
-    Calculation of False Positives in non-binary setting.
-    If an ancestor-prediction does not have an ancestor-gold counterpart, it is considered a FP.
-    Hence, the overall FP for an ancestor represents how many more times the ancestor has been predicted in a document
-    compared to how many times it appears in the gold standard.
-
-    inputs
-      pred: numpy array of predictions
-      gold: numpy array of true labels
-      axes: axes on which summing is to be performed (all dimensions for overall FP)
-    returns integer if axes represent all dimensions, a vector of integers otherwise
-    """
-    return np.sum(np.maximum(pred - gold, 0), axis=axes)
-
-
-def fn_matrix_mul(pred, gold, axes):
-    """
-    Calculation of False Negatives in non-binary setting.
-    If an ancestor-gold does not have an ancestor-prediction counterpart, it is considered a FN.
-    Hence, the overall FN for an ancestor represents how many more times the ancestor appears in a document
-    compared to how many times it was predicted for the document.
-
-    inputs
-      pred: numpy array of predictions
-      gold: numpy array of true labels
-      axes: axes on which summing is to be performed (all dimensions for overall FN)
-    returns integer if axes represent all dimensions, a vector of integers otherwise
-    """
-    return np.sum(np.maximum(gold - pred, 0), axis=axes)
-
-
-def tp_matrix_mul_full(pred, gold, axes=(0, 1)):
-    """
-    Overall TP for a non-binary 2d matrix
-    returns integer
-    """
-    return tp_matrix_mul(pred, gold, axes)
-
-
-def fp_matrix_mul_full(pred, gold, axes=(0, 1)):
-    """
-    Overall FP for a non-binary 2d matrix
-    returns integer
-    """
-    return fp_matrix_mul(pred, gold, axes)
-
-
-def fn_matrix_mul_full(pred, gold, axes=(0, 1)):
-    """
-    Overall FN for a non-binary 2d matrix
-    returns integer
-    """
-    return fn_matrix_mul(pred, gold, axes)
-
-
-def tp_matrix_mul_per_class(pred, gold, axes=0):
-    """
-    per-class TP for a non-binary 2d matrix
-    returns 1d np.array
-    """
-    return tp_matrix_mul(pred, gold, axes)
-
-
-def fp_matrix_mul_per_class(pred, gold, axes=0):
-    """
-    per-class FP for a non-binary 2d matrix
-    returns 1d np.array
-    """
-    return fp_matrix_mul(pred, gold, axes)
-
-
-def fn_matrix_mul_per_class(pred, gold, axes=0):
-    """
-    per-class FN for a non-binary 2d matrix
-    returns 1d np.array
-    """
-    return fn_matrix_mul(pred, gold, axes)
-
-
-def report(pred, gold, code_id_dict):
-    """
-    Creates a per-class dataframe report.
-    This includes the Precision, Recall, F1 score, Support in the evaluation set, and the code itself.
-    inputs:
-        pred          2d np.array prediction matrix
-        gold          2d np.array matrix of gold standard labels
-        code_id_dict  dictionary mapping codes to their ID in the prediction/gold vectors
-    returns Pandas DataFrame
-    """
-
-    # Calculation of TP/FP/FN per class
-    tp = tp_matrix_mul_per_class(pred, gold)
-    fp = fp_matrix_mul_per_class(pred, gold)
-    fn = fn_matrix_mul_per_class(pred, gold)
-
-    # Calculation of the support within the evaluation set
-    support = np.sum(gold, axis=0)
-
-    # Precision
-    prec_denom = tp + fp
-    prec_denom_corrected = prec_denom + (prec_denom == 0) * 1
-    prec = tp / prec_denom_corrected
-
-    # Recall
-    rec_denom = tp + fn
-    rec_denom_corrected = rec_denom + (rec_denom == 0) * 1
-    rec = tp / (rec_denom_corrected)
-
-    # F1 score
-    f1_denom = prec + rec
-    f1_denom_corrected = f1_denom + ((f1_denom == 0) * 1)
-    f1 = 2 * (prec * rec) / (f1_denom_corrected)
-
-    # matchin codes
-    code_ids = sorted(code_id_dict)
-    codes = [code_id_dict[k] for k in code_ids]
-
-    df = pd.DataFrame(
-        list(zip(prec, rec, f1, support, codes)),
-        columns=["Precision", "Recall", "F1", "Support", "Code"],
-    )
-    return df
-
-
-def report_micro(pred, gold):
-    """
-    Creates an overall report on the micro lvel.
-    This includes the micro Precision, Recall, F1 score.
-    inputs:
-        pred          2d np.array prediction matrix
-        gold          2d np.array matrix of gold standard labels
-        code_id_dict  dictionary mapping codes to their ID in the prediction/gold vectors
-    returns a dictionary with real values for "Precision", "Recall", and "F1"
-    """
-    tp = tp_matrix_mul_full(pred, gold)
-    fp = fp_matrix_mul_full(pred, gold)
-    fn = fn_matrix_mul_full(pred, gold)
-
-    prec_denom = tp + fp
-    prec_denom_corrected = prec_denom + (prec_denom == 0) * 1
-    prec_micro = tp / prec_denom_corrected
-
-    rec_denom = tp + fn
-    rec_denom_corrected = rec_denom + (rec_denom == 0) * 1
-    rec_micro = tp / (rec_denom_corrected)
-
-    f1_denom = prec_micro + rec_micro
-    f1_denom_corrected = f1_denom + ((f1_denom == 0) * 1)
-    f1 = 2 * (prec_micro * rec_micro) / (f1_denom_corrected)
-
-    report_dict = dict({"Precision": prec_micro, "Recall": rec_micro, "F1": f1})
-
-    return report_dict
-
-
-def report_macro(pred, gold):
-    """
-    Creates an overall report on the macro lvel.
-    This includes the macro Precision, Recall, F1 score.
-    inputs:
-        pred          2d np.array prediction matrix
-        gold          2d np.array matrix of gold standard labels
-        code_id_dict  dictionary mapping codes to their ID in the prediction/gold vectors
-    returns a dictionary with real values for "Precision", "Recall", and "F1"
-    """
-    tp = tp_matrix_mul_per_class(pred, gold)
-    fp = fp_matrix_mul_per_class(pred, gold)
-    fn = fn_matrix_mul_per_class(pred, gold)
-
-    prec_denom = tp + fp
-    prec_denom_corrected = prec_denom + (prec_denom == 0) * 1
-    prec = tp / prec_denom_corrected
-    prec_macro = np.average(prec, axis=0)
-
-    rec_denom = tp + fn
-    rec_denom_corrected = rec_denom + (rec_denom == 0) * 1
-    rec = tp / (rec_denom_corrected)
-    rec_macro = np.average(rec, axis=0)
-
-    f1_denom = prec_macro + rec_macro
-    f1_denom_corrected = f1_denom + ((f1_denom == 0) * 1)
-    f1 = 2 * (prec_macro * rec_macro) / (f1_denom_corrected)
-    report_dict = dict({"Precision": prec_macro, "Recall": rec_macro, "F1": f1})
-
-    return report_dict
-
-
-def report_macro_bin(pred, gold):
-    """
-    binarised version of report_macro - the prediction and gold matrix are set to binary,
-    where positive entries are set to 1.
-
-    return report_macro on these binarised inputs
-    """
-    pred_bin = (pred > 0) * 1
-    gold_bin = (gold > 0) * 1
-    return report_macro(pred_bin, gold_bin)
-
-
-def report_micro_bin(pred, gold):
-    """
-    binarised version of report_micro - the prediction and gold matrix are set to binary,
-    where positive entries are set to 1.
-
-    return report_micro on these binarised inputs
-    """
-    pred_bin = (pred > 0) * 1
-    gold_bin = (gold > 0) * 1
-    return report_micro(pred_bin, gold_bin)
-
-
-def report_bin(pred, gold, code_id_dict):
-    """
-    Creates a per-class dataframe report on binarised inputs.
-    """
-    pred_bin = (pred > 0) * 1
-    gold_bin = (gold > 0) * 1
-    return report(pred_bin, gold_bin, code_id_dict)
-
-
-def hierarchical_evaluation(
-    pred, gold, code_ids, translation_dict, max_onto_layers=3, verbo=False
-):
-    """
-    A summary function for final reporting.
-    Inputs:
-        pred                2d np.array prediction matrix
-        gold                2d np.array matrix of gold standard labels
-        code_ids            dictionary mapping codes to their ID in the prediction/gold vectors
-        translation_dict    dictionary mapping codes to their ID in the prediction/gold vectors
-        max_onto_layers           an integer describing the maximum layer (from the bottom up) within the ontology to be evaluated on
-        verbo               whether to verbolise the translation matrices
-    Return 4 variables:
-        micro prec for the overall hierarchical evaluation,
-        rec for the overall hierarchical evaluation,
-        f1 for the overall hierarchical evaluation,
-        the list of results per layer, from layer 1 (leaf node only) up to layer 4 (so there are 4 sets of results, each set has 3 metrics, i.e. micro prec,rec,f1).
-    """
-    matrices, layer_id_dicts = combined_matrix_setup(
-        code_ids, translation_dict, max_layer=max_onto_layers
-    )
-    if verbo:
-        logging.info("========TRANSLATION MATRICES========")
-        for layer_ind in range(max_onto_layers + 1):
-            logging.info("Layer %s labels:" % (str(layer_ind + 1)))
-            logging.info(
-                matrices[layer_ind].shape,
-                matrices[layer_ind].toarray(),
-                layer_id_dicts[layer_ind],
-            )
-            logging.info("====================================")
-
-    combined_preds, combined_golds = hierarchical_eval_setup(
-        pred, gold, matrices, max_onto_layers=max_onto_layers
-    )
-    logging.info("hiearchical evaluation - micro-level results")
-    logging.info("overall hierarchical evaluation results:")
-    he_micro_dict = report_micro(combined_preds, combined_golds)
-    # he_macro_dict = report_macro(combined_preds, combined_golds)
-    he_micro_prec, he_micro_rec, he_micro_f1 = (
-        he_micro_dict["Precision"],
-        he_micro_dict["Recall"],
-        he_micro_dict["F1"],
-    )
-    logging.info(he_micro_dict)
-    logging.info("overall set-based results:")
-    he_micro_set_based_dict = report_micro_bin(combined_preds, combined_golds)
-    logging.info(he_micro_set_based_dict)
-
-    list_results_by_layer = []
-    # get results and loop over parent levels
-    for layer_ind in range(max_onto_layers + 1):
-        child_to_parent_matrix = matrices[layer_ind].toarray()
-
-        pred_sparse = csr_matrix(pred)
-        gold_sparse = csr_matrix(gold)
-        child_to_parent_matrix_sparse = csr_matrix(child_to_parent_matrix)
-
-        parent_pred_matrix = pred_sparse.dot(child_to_parent_matrix_sparse).toarray()
-        parent_gold_matrix = gold_sparse.dot(child_to_parent_matrix_sparse).toarray()
-        logging.info("result at layer %s" % str(layer_ind + 1))
-        he_micro_dict = report_micro(parent_pred_matrix, parent_gold_matrix)
-        # he_macro_dict = report_macro(parent_pred_matrix, parent_gold_matrix)
-        he_micro_prec_layer, he_micro_rec_layer, he_micro_f1_layer = (
-            he_micro_dict["Precision"],
-            he_micro_dict["Recall"],
-            he_micro_dict["F1"],
-        )
-
-        logging.info(he_micro_dict)
-
-        for metric_per_layer in (
-            he_micro_prec_layer,
-            he_micro_rec_layer,
-            he_micro_f1_layer,
-        ):
-            list_results_by_layer.append(metric_per_layer)
-
-    return he_micro_prec, he_micro_rec, he_micro_f1, list_results_by_layer
-
-
-if __name__ == "__main__":
-    logging.info(f"Hierarchical Evaluation Demonstration")
-    logging.info(f"Vectors correspond to leafs: \n(a.1, a.2, a.3, b.1, b.2, c.1, d)")
-    logging.info(f"Their corresponding level 1 are: \b (a, a, a, b, b, c, d)")
-
-    leaf_dict = dict(zip(range(7), ["a.1", "a.2", "a.3", "b.1", "b.2", "c.1", "d"]))
-    logging.info("Gold Standard")
-    gold_matrix = np.array(
-        [
-            [0, 0, 1, 0, 1, 0, 1],
-            [0, 1, 0, 0, 0, 1, 0],
-            [1, 0, 1, 1, 0, 1, 0],
-            [0, 0, 1, 1, 1, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0],
-            [0, 0, 1, 0, 0, 0, 1],
-            [0, 0, 1, 1, 1, 0, 1],
-        ]
-    )  # sample matrix gold standard
-    logging.info(gold_matrix)
-
-    logging.info("Prediction")
-    pred_matrix = np.array(
-        [
-            [0, 1, 1, 0, 1, 0, 0],
-            [0, 1, 0, 0, 0, 1, 0],
-            [0, 1, 1, 1, 0, 0, 1],
-            [0, 0, 1, 1, 1, 0, 0],
-            [1, 1, 0, 1, 0, 0, 0],
-            [0, 0, 0, 0, 0, 0, 0],
-            [1, 1, 1, 1, 1, 1, 1],
-        ]
-    )  # sample matrix prediction
-    logging.info(pred_matrix)
-
-    test_tp_mul = tp_matrix_mul_per_class(pred_matrix, gold_matrix)
-    test_fp_mul = fp_matrix_mul_per_class(pred_matrix, gold_matrix)
-    test_fn_mul = fn_matrix_mul_per_class(pred_matrix, gold_matrix)
-
-    logging.info(f"TP: {test_tp_mul} FP: {test_fp_mul} FN:{test_fn_mul}")
-
-    logging.info(report(pred_matrix, gold_matrix, leaf_dict))
-
-    logging.info("============================================")
-    logging.info("=============PARENT-LEVEL===================")
-    logging.info("============================================")
-
-    child_to_parent_matrix = np.array(
-        [
-            [1, 0, 0, 0],
-            [1, 0, 0, 0],
-            [1, 0, 0, 0],
-            [0, 1, 0, 0],
-            [0, 1, 0, 0],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1],
-        ]
-    )
-
-    parent_pred_matrix = pred_matrix.dot(child_to_parent_matrix)
-    parent_gold_matrix = gold_matrix.dot(child_to_parent_matrix)
-
-    parent_dict = dict(zip(range(4), ["a", "b", "c", "d"]))
-
-    logging.info("Parent-Translated Gold Standard")
-    logging.info(parent_gold_matrix)
-    logging.info("Parent-Translated Prediction")
-    logging.info(parent_pred_matrix)
-
-    logging.info(report(parent_pred_matrix, parent_gold_matrix, parent_dict))
+import logging
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from numba import int8 as numba_int8
+from numba import int16 as numba_int16
+from numba import njit, prange
+from scipy.sparse import issparse
+
+from .evaluation_setup import combined_matrix_setup
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def _sparse_sum(matrix, axes):
+    """
+    Sums a sparse TP/FP/FN matrix the way the dense helpers do: axes covering
+    all dimensions yield a scalar, a single axis yields a 1d np.array.
+    """
+    if axes == (0, 1) or axes is None:
+        return matrix.sum()
+    return np.asarray(matrix.sum(axis=axes)).ravel()
+
+
+def tp_matrix_mul(pred, gold, axes):
+    """
+    Calculation of True Positives in non-binary setting.
+    On the ancestor levels leaf-level mismatches do not matter. If an ancestor-prediction has an ancestor-gold counterpart,
+    it is considered a TP. Hence, the overall TP for an ancestor is the minimum of the count of the predicted ancestor
+    and the count of the gold standard ancestor.
+
+    inputs
+      pred: numpy array of predictions
+      gold: numpy array of true labels
+      axes: axes on which summing is to be performed (all dimensions for overall TP)
+    returns integer if axes represent all dimensions, a vector of integers otherwise
+    """
+    if issparse(pred):
+        return _sparse_sum(pred.minimum(gold), axes)  # O(nnz), never densifies
+    return np.sum(np.minimum(pred, gold), axis=axes)
+
+
+def fp_matrix_mul(pred, gold, axes):
+    """
+    Calculation of False Positives in non-binary setting.
+    If an ancestor-prediction does not have an ancestor-gold counterpart, it is considered a FP.
+    Hence, the overall FP for an ancestor represents how many more times the ancestor has been predicted in a document
+    compared to how many times it appears in the gold standard.
+
+    inputs
+      pred: numpy array of predictions
+      gold: numpy array of true labels
+      axes: axes on which summing is to be performed (all dimensions for overall FP)
+    returns integer if axes represent all dimensions, a vector of integers otherwise
+    """
+    if issparse(pred):
+        return _sparse_sum((pred - gold).maximum(0), axes)
+    return np.sum(np.maximum(pred - gold, 0), axis=axes)
+
+
+def fn_matrix_mul(pred, gold, axes):
+    """
+    Calculation of False Negatives in non-binary setting.
+    If an ancestor-gold does not have an ancestor-prediction counterpart, it is considered a FN.
+    Hence, the overall FN for an ancestor represents how many more times the ancestor appears in a document
+    compared to how many times it was predicted for the document.
+
+    inputs
+      pred: numpy array of predictions
+      gold: numpy array of true labels
+      axes: axes on which summing is to be performed (all dimensions for overall FN)
+    returns integer if axes represent all dimensions, a vector of integers otherwise
+    """
+    if issparse(pred):
+        return _sparse_sum((gold - pred).maximum(0), axes)
+    return np.sum(np.maximum(gold - pred, 0), axis=axes)
+
+
+def tp_matrix_mul_full(pred, gold, axes=(0, 1)):
+    """
+    Overall TP for a non-binary 2d matrix
+    returns integer
+    """
+    return tp_matrix_mul(pred, gold, axes)
+
+
+def fp_matrix_mul_full(pred, gold, axes=(0, 1)):
+    """
+    Overall FP for a non-binary 2d matrix
+    returns integer
+    """
+    return fp_matrix_mul(pred, gold, axes)
+
+
+def fn_matrix_mul_full(pred, gold, axes=(0, 1)):
+    """
+    Overall FN for a non-binary 2d matrix
+    returns integer
+    """
+    return fn_matrix_mul(pred, gold, axes)
+
+
+@njit(parallel=True, cache=True)
+def tpfpfn_per_class(pred, gold):
+    """
+    Fused calculation of per-class TP, FP, and FN in the non-binary setting.
+    The three counts share the same definitions as tp_matrix_mul, fp_matrix_mul,
+    and fn_matrix_mul, but are accumulated in a single pass over pred and gold
+    instead of three, so each matrix is streamed through memory only once.
+    Parallelism is over blocks of columns so that the innermost loop touches
+    contiguous elements, which LLVM auto-vectorizes - on the narrow int8/int16
+    inputs this runs SIMD-wide instead of scalar.
+
+    inputs
+      pred: 2d numpy array of predictions
+      gold: 2d numpy array of true labels
+    returns a tuple of four 1d int64 np.arrays (tp, fp, fn, support), one entry
+    per class; support is the per-class column sum of gold, which comes for
+    free in the same pass
+    """
+    n_docs, n_classes = pred.shape
+    tp = np.zeros(n_classes, dtype=np.int64)
+    fp = np.zeros(n_classes, dtype=np.int64)
+    fn = np.zeros(n_classes, dtype=np.int64)
+    support = np.zeros(n_classes, dtype=np.int64)
+    block = 256
+    n_blocks = (n_classes + block - 1) // block
+    for b in prange(n_blocks):
+        start = b * block
+        stop = min(start + block, n_classes)
+        for i in range(n_docs):
+            for j in range(start, stop):
+                p = pred[i, j]
+                g = gold[i, j]
+                support[j] += g
+                if p < g:
+                    tp[j] += p
+                    fn[j] += g - p
+                else:
+                    tp[j] += g
+                    fp[j] += p - g
+    return tp, fp, fn, support
+
+
+# pre-specialize the storage dtypes the pipeline actually produces (int8 from
+# the binarised reports, int16 from hierarchical_eval_setup) so the first
+# evaluation hits the on-disk cache instead of pausing to JIT; other dtypes
+# still compile lazily
+for _signature in (
+    (numba_int8[:, ::1], numba_int8[:, ::1]),
+    (numba_int16[:, ::1], numba_int16[:, ::1]),
+):
+    tpfpfn_per_class.compile(_signature)
+
+
+def _integer_counts(pred, gold):
+    """
+    Whether both matrices hold integer counts and may enter the fused Numba
+    kernel, whose int64 accumulators would silently truncate float values.
+    """
+    return np.issubdtype(pred.dtype, np.integer) and np.issubdtype(
+        gold.dtype, np.integer
+    )
+
+
+def tpfpfn_full(pred, gold):
+    """
+    Fused calculation of the overall TP, FP, and FN in the non-binary setting.
+
+    inputs
+      pred: 2d numpy (or scipy sparse) array of predictions
+      gold: 2d numpy (or scipy sparse) array of true labels
+    returns a tuple of three numbers (tp, fp, fn)
+    """
+    if issparse(pred) or not _integer_counts(pred, gold):
+        return (
+            tp_matrix_mul_full(pred, gold),
+            fp_matrix_mul_full(pred, gold),
+            fn_matrix_mul_full(pred, gold),
+        )
+    tp, fp, fn, _ = tpfpfn_per_class(pred, gold)
+    return tp.sum(), fp.sum(), fn.sum()
+
+
+def _aggregate_tpfpfn_exact(preds, golds, layer_matrix):
+    """
+    Exact fallback for aggregate_tpfpfn on non-integer inputs, whose values
+    the kernel's integer accumulators would silently truncate. Translates
+    through the sparse dot and reduces with the NumPy helpers instead, at the
+    cost of materializing the dense translated blocks.
+    returns a tuple of six numbers (tp, fp, fn, tp_bin, fp_bin, fn_bin)
+    """
+    translated_preds = preds @ layer_matrix
+    translated_golds = golds @ layer_matrix
+    pred_bin = _binarize(translated_preds)
+    gold_bin = _binarize(translated_golds)
+    return (
+        tp_matrix_mul_full(translated_preds, translated_golds),
+        fp_matrix_mul_full(translated_preds, translated_golds),
+        fn_matrix_mul_full(translated_preds, translated_golds),
+        tp_matrix_mul_full(pred_bin, gold_bin),
+        fp_matrix_mul_full(pred_bin, gold_bin),
+        fn_matrix_mul_full(pred_bin, gold_bin),
+    )
+
+
+def _tpfpfn_counts(pred, gold):
+    """
+    Per-class TP/FP/FN/support for dense or sparse inputs. Dense integer
+    matrices go through the fused Numba kernel; sparse ones stay in O(nnz)
+    CSR arithmetic and float ones keep the exact NumPy reductions.
+    """
+    if issparse(pred):
+        return (
+            tp_matrix_mul_per_class(pred, gold),
+            fp_matrix_mul_per_class(pred, gold),
+            fn_matrix_mul_per_class(pred, gold),
+            np.asarray(gold.sum(axis=0)).ravel(),
+        )
+    if not _integer_counts(pred, gold):
+        return (
+            tp_matrix_mul_per_class(pred, gold),
+            fp_matrix_mul_per_class(pred, gold),
+            fn_matrix_mul_per_class(pred, gold),
+            np.sum(gold, axis=0),
+        )
+    return tpfpfn_per_class(pred, gold)
+
+
+@njit(parallel=True, cache=True)
+def aggregate_tpfpfn(preds, golds, indptr, indices, data, n_ancestors):
+    """
+    Overall TP/FP/FN for one ontology layer, computed directly from the CSR
+    structure of its leaf-to-ancestor translation matrix. Each document's
+    leaf counts are scattered onto the layer's ancestors through the sparse
+    rows, and the non-binary and set-based (binarised) counts are accumulated
+    in the same sweep - the dense N x K' translated matrices are never
+    materialized.
+
+    inputs
+      preds: 2d numpy array of leaf-level predictions
+      golds: 2d numpy array of leaf-level true labels
+      indptr, indices, data: the CSR arrays of the layer's translation matrix
+      n_ancestors: number of columns (ancestors) of the translation matrix
+    returns a tuple of six integers (tp, fp, fn, tp_bin, fp_bin, fn_bin)
+    """
+    n_docs, n_leaves = preds.shape
+    tp, fp, fn = 0, 0, 0
+    tp_bin, fp_bin, fn_bin = 0, 0, 0
+    for i in prange(n_docs):
+        pred_anc = np.zeros(n_ancestors, dtype=np.int64)
+        gold_anc = np.zeros(n_ancestors, dtype=np.int64)
+        for leaf in range(n_leaves):
+            p = preds[i, leaf]
+            g = golds[i, leaf]
+            if p != 0 or g != 0:
+                for idx in range(indptr[leaf], indptr[leaf + 1]):
+                    w = data[idx]
+                    if w != 0:  # stored zeros mark suppressed duplicate edges
+                        pred_anc[indices[idx]] += p * w
+                        gold_anc[indices[idx]] += g * w
+        for col in range(n_ancestors):
+            pa = pred_anc[col]
+            ga = gold_anc[col]
+            if pa < ga:
+                tp += pa
+                fn += ga - pa
+            else:
+                tp += ga
+                fp += pa - ga
+            if pa > 0 and ga > 0:
+                tp_bin += 1
+            elif pa > 0:
+                fp_bin += 1
+            elif ga > 0:
+                fn_bin += 1
+    return tp, fp, fn, tp_bin, fp_bin, fn_bin
+
+
+def tp_matrix_mul_per_class(pred, gold, axes=0):
+    """
+    per-class TP for a non-binary 2d matrix
+    returns 1d np.array
+    """
+    return tp_matrix_mul(pred, gold, axes)
+
+
+def fp_matrix_mul_per_class(pred, gold, axes=0):
+    """
+    per-class FP for a non-binary 2d matrix
+    returns 1d np.array
+    """
+    return fp_matrix_mul(pred, gold, axes)
+
+
+def fn_matrix_mul_per_class(pred, gold, axes=0):
+    """
+    per-class FN for a non-binary 2d matrix
+    returns 1d np.array
+    """
+    return fn_matrix_mul(pred, gold, axes)
+
+
+class ReportArrays(NamedTuple):
+    """
+    Per-class report as raw 1d arrays - constructing a DataFrame costs
+    milliseconds per call, which dominates when report runs inside a
+    training-eval loop across layers and epochs, so the DataFrame is only
+    built on demand via to_dataframe().
+    """
+
+    precision: np.ndarray
+    recall: np.ndarray
+    f1: np.ndarray
+    support: np.ndarray
+    codes: list
+
+    def to_dataframe(self):
+        """
+        The per-class report as a pandas DataFrame, for display and notebooks.
+        """
+        return pd.DataFrame(
+            {
+                "Precision": self.precision,
+                "Recall": self.recall,
+                "F1": self.f1,
+                "Support": self.support,
+                "Code": self.codes,
+            }
+        )
+
+
+def _binarize(matrix):
+    """
+    0/1 int8 version of a count matrix; sparse inputs stay sparse and dense
+    inputs reuse the comparison buffer via a zero-copy view.
+    """
+    if issparse(matrix):
+        return (matrix > 0).astype(np.int8)
+    return (matrix > 0).view(np.int8)
+
+
+_sorted_codes_cache = {}  # id(code_id_dict) -> (code_id_dict, sorted codes list)
+
+
+def _sorted_codes(code_id_dict):
+    """
+    Returns the codes of code_id_dict ordered by their ID.
+    Sorting ~20k ICD codes on every report call is pure Python overhead, so the
+    result is cached per dictionary (the dictionary itself is kept in the cache
+    entry so its id cannot be reused while cached).
+    """
+    cached = _sorted_codes_cache.get(id(code_id_dict))
+    if (
+        cached is not None
+        and cached[0] is code_id_dict
+        and len(cached[1]) == len(code_id_dict)
+    ):
+        return cached[1]
+    codes = [code_id_dict[k] for k in sorted(code_id_dict)]
+    if len(_sorted_codes_cache) >= 8:
+        _sorted_codes_cache.pop(next(iter(_sorted_codes_cache)))
+    _sorted_codes_cache[id(code_id_dict)] = (code_id_dict, codes)
+    return codes
+
+
+def report(pred, gold, code_id_dict):
+    """
+    Creates a per-class report.
+    This includes the Precision, Recall, F1 score, Support in the evaluation set, and the code itself.
+    inputs:
+        pred          2d np.array prediction matrix
+        gold          2d np.array matrix of gold standard labels
+        code_id_dict  dictionary mapping codes to their ID in the prediction/gold vectors
+    returns ReportArrays (use .to_dataframe() for a Pandas DataFrame)
+    """
+
+    # Calculation of TP/FP/FN and the support within the evaluation set
+    # per class in a single fused pass
+    tp, fp, fn, support = _tpfpfn_counts(pred, gold)
+
+    # Precision - classes with an empty denominator are reported as 0
+    prec_denom = tp + fp
+    prec = np.divide(
+        tp, prec_denom, out=np.zeros_like(tp, dtype=np.float64), where=prec_denom > 0
+    )
+
+    # Recall
+    rec_denom = tp + fn
+    rec = np.divide(
+        tp, rec_denom, out=np.zeros_like(tp, dtype=np.float64), where=rec_denom > 0
+    )
+
+    # F1 score
+    f1_denom = prec + rec
+    f1 = np.divide(
+        2 * prec * rec, f1_denom, out=np.zeros_like(prec), where=f1_denom > 0
+    )
+
+    # matchin codes
+    codes = _sorted_codes(code_id_dict)
+
+    return ReportArrays(prec, rec, f1, support, codes)
+
+
+def report_micro_from_counts(tp, fp, fn):
+    """
+    Micro Precision, Recall, and F1 from pre-aggregated overall TP/FP/FN counts.
+    returns a dictionary with real values for "Precision", "Recall", and "F1"
+    """
+    # scalar counts - empty denominators are reported as 0
+    prec_micro = tp / (tp + fp) if tp + fp > 0 else 0.0
+    rec_micro = tp / (tp + fn) if tp + fn > 0 else 0.0
+    f1_denom = prec_micro + rec_micro
+    f1 = 2 * (prec_micro * rec_micro) / f1_denom if f1_denom > 0 else 0.0
+
+    return dict({"Precision": prec_micro, "Recall": rec_micro, "F1": f1})
+
+
+def report_micro(pred, gold):
+    """
+    Creates an overall report on the micro lvel.
+    This includes the micro Precision, Recall, F1 score.
+    inputs:
+        pred          2d np.array prediction matrix
+        gold          2d np.array matrix of gold standard labels
+        code_id_dict  dictionary mapping codes to their ID in the prediction/gold vectors
+    returns a dictionary with real values for "Precision", "Recall", and "F1"
+    """
+    tp, fp, fn = tpfpfn_full(pred, gold)
+    return report_micro_from_counts(tp, fp, fn)
+
+
+def report_macro(pred, gold, ignore_empty=True):
+    """
+    Creates an overall report on the macro lvel.
+    This includes the macro Precision, Recall, F1 score.
+    inputs:
+        pred          2d np.array prediction matrix
+        gold          2d np.array matrix of gold standard labels
+        ignore_empty  boolean, default = True; averages only over classes that
+                      appear in pred or gold (tp+fp+fn > 0). Long-tail code sets
+                      are mostly empty in a given fold, and empty classes would
+                      otherwise contribute a hard 0 to every macro average.
+    returns a dictionary with real values for "Precision", "Recall", and "F1"
+    """
+    tp, fp, fn, _ = _tpfpfn_counts(pred, gold)
+
+    if ignore_empty:
+        active = (tp + fp + fn) > 0
+        if not active.any():
+            # nothing predicted and nothing to find - report clean zeros
+            # instead of averaging over an empty selection
+            return dict({"Precision": 0.0, "Recall": 0.0, "F1": 0.0})
+        tp, fp, fn = tp[active], fp[active], fn[active]
+
+    prec_denom = tp + fp
+    prec = np.divide(
+        tp, prec_denom, out=np.zeros_like(tp, dtype=np.float64), where=prec_denom > 0
+    )
+    prec_macro = np.average(prec, axis=0)
+
+    rec_denom = tp + fn
+    rec = np.divide(
+        tp, rec_denom, out=np.zeros_like(tp, dtype=np.float64), where=rec_denom > 0
+    )
+    rec_macro = np.average(rec, axis=0)
+
+    f1_denom = prec_macro + rec_macro
+    f1 = 2 * (prec_macro * rec_macro) / f1_denom if f1_denom > 0 else 0.0
+    report_dict = dict({"Precision": prec_macro, "Recall": rec_macro, "F1": f1})
+
+    return report_dict
+
+
+def report_macro_bin(pred, gold, ignore_empty=True):
+    """
+    binarised version of report_macro - the prediction and gold matrix are set to binary,
+    where positive entries are set to 1.
+
+    return report_macro on these binarised inputs
+    """
+    pred_bin = _binarize(pred)
+    gold_bin = _binarize(gold)
+    return report_macro(pred_bin, gold_bin, ignore_empty=ignore_empty)
+
+
+def report_micro_bin(pred, gold):
+    """
+    binarised version of report_micro - the prediction and gold matrix are set to binary,
+    where positive entries are set to 1.
+
+    return report_micro on these binarised inputs
+    """
+    pred_bin = _binarize(pred)
+    gold_bin = _binarize(gold)
+    return report_micro(pred_bin, gold_bin)
+
+
+def report_bin(pred, gold, code_id_dict):
+    """
+    Creates a per-class report on binarised inputs.
+    returns ReportArrays (use .to_dataframe() for a Pandas DataFrame)
+    """
+    pred_bin = _binarize(pred)
+    gold_bin = _binarize(gold)
+    return report(pred_bin, gold_bin, code_id_dict)
+
+
+def hierarchical_evaluation(
+    pred, gold, code_ids, translation_dict, max_onto_layers=3, verbo=False
+):
+    """
+    A summary function for final reporting.
+    Inputs:
+        pred                2d np.array prediction matrix
+        gold                2d np.array matrix of gold standard labels
+        code_ids            dictionary mapping codes to their ID in the prediction/gold vectors
+        translation_dict    dictionary mapping codes to their ID in the prediction/gold vectors
+        max_onto_layers           an integer describing the maximum layer (from the bottom up) within the ontology to be evaluated on
+        verbo               whether to verbolise the translation matrices
+    Return 4 variables:
+        micro prec for the overall hierarchical evaluation,
+        rec for the overall hierarchical evaluation,
+        f1 for the overall hierarchical evaluation,
+        the list of results per layer, from layer 1 (leaf node only) up to layer 4 (so there are 4 sets of results, each set has 3 metrics, i.e. micro prec,rec,f1).
+    """
+    matrices, layer_id_dicts = combined_matrix_setup(
+        code_ids, translation_dict, max_layer=max_onto_layers
+    )
+    if verbo:
+        logging.info("========TRANSLATION MATRICES========")
+        for layer_ind in range(max_onto_layers + 1):
+            logging.info("Layer %s labels:" % (str(layer_ind + 1)))
+            logging.info(
+                matrices[layer_ind].shape,
+                matrices[layer_ind].toarray(),
+                layer_id_dicts[layer_ind],
+            )
+            logging.info("====================================")
+
+    # aggregate TP/FP/FN per layer straight from the CSR translation matrices -
+    # the dense N x K' translated blocks are never materialized
+    pred_arr = np.ascontiguousarray(pred)
+    gold_arr = np.ascontiguousarray(gold)
+    use_kernel = _integer_counts(pred_arr, gold_arr)
+    counts_by_layer = []
+    for layer_ind in range(max_onto_layers + 1):
+        layer_matrix = matrices[layer_ind].tocsr()
+        if use_kernel:
+            counts_by_layer.append(
+                aggregate_tpfpfn(
+                    pred_arr,
+                    gold_arr,
+                    layer_matrix.indptr,
+                    layer_matrix.indices,
+                    layer_matrix.data,
+                    layer_matrix.shape[1],
+                )
+            )
+        else:
+            counts_by_layer.append(
+                _aggregate_tpfpfn_exact(pred_arr, gold_arr, layer_matrix)
+            )
+
+    logging.info("hiearchical evaluation - micro-level results")
+    logging.info("overall hierarchical evaluation results:")
+    overall = [
+        sum(layer_counts[i] for layer_counts in counts_by_layer) for i in range(6)
+    ]
+    he_micro_dict = report_micro_from_counts(*overall[:3])
+    he_micro_prec, he_micro_rec, he_micro_f1 = (
+        he_micro_dict["Precision"],
+        he_micro_dict["Recall"],
+        he_micro_dict["F1"],
+    )
+    logging.info(he_micro_dict)
+    logging.info("overall set-based results:")
+    he_micro_set_based_dict = report_micro_from_counts(*overall[3:])
+    logging.info(he_micro_set_based_dict)
+
+    list_results_by_layer = []
+    # get results and loop over parent levels
+    for layer_ind in range(max_onto_layers + 1):
+        logging.info("result at layer %s" % str(layer_ind + 1))
+        he_micro_dict = report_micro_from_counts(*counts_by_layer[layer_ind][:3])
+        he_micro_prec_layer, he_micro_rec_layer, he_micro_f1_layer = (
+            he_micro_dict["Precision"],
+            he_micro_dict["Recall"],
+            he_micro_dict["F1"],
+        )
+
+        logging.info(he_micro_dict)
+
+        for metric_per_layer in (
+            he_micro_prec_layer,
+            he_micro_rec_layer,
+            he_micro_f1_layer,
+        ):
+            list_results_by_layer.append(metric_per_layer)
+
+    return he_micro_prec, he_micro_rec, he_micro_f1, list_results_by_layer
+
+
+if __name__ == "__main__":
+    logging.info(f"Hierarchical Evaluation Demonstration")
+    logging.info(f"Vectors correspond to leafs: \n(a.1, a.2, a.3, b.1, b.2, c.1, d)")
+    logging.info(f"Their corresponding level 1 are: \b (a, a, a, b, b, c, d)")
+
+    leaf_dict = dict(zip(range(7), ["a.1", "a.2", "a.3", "b.1", "b.2", "c.1", "d"]))
+    logging.info("Gold Standard")
+    gold_matrix = np.array(
+        [
+            [0, 0, 1, 0, 1, 0, 1],
+            [0, 1, 0, 0, 0, 1, 0],
+            [1, 0, 1, 1, 0, 1, 0],
+            [0, 0, 1, 1, 1, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0, 1],
+            [0, 0, 1, 1, 1, 0, 1],
+        ]
+    )  # sample matrix gold standard
+    logging.info(gold_matrix)
+
+    logging.info("Prediction")
+    pred_matrix = np.array(
+        [
+            [0, 1, 1, 0, 1, 0, 0],
+            [0, 1, 0, 0, 0, 1, 0],
+            [0, 1, 1, 1, 0, 0, 1],
+            [0, 0, 1, 1, 1, 0, 0],
+            [1, 1, 0, 1, 0, 0, 0],
+            [0, 0, 0, 0, 0, 0, 0],
+            [1, 1, 1, 1, 1, 1, 1],
+        ]
+    )  # sample matrix prediction
+    logging.info(pred_matrix)
+
+    test_tp_mul = tp_matrix_mul_per_class(pred_matrix, gold_matrix)
+    test_fp_mul = fp_matrix_mul_per_class(pred_matrix, gold_matrix)
+    test_fn_mul = fn_matrix_mul_per_class(pred_matrix, gold_matrix)
+
+    logging.info(f"TP: {test_tp_mul} FP: {test_fp_mul} FN:{test_fn_mul}")
+
+    logging.info(report(pred_matrix, gold_matrix, leaf_dict).to_dataframe())
+
+    logging.info("============================================")
+    logging.info("=============PARENT-LEVEL===================")
+    logging.info("============================================")
+
+    child_to_parent_matrix = np.array(
+        [
+            [1, 0, 0, 0],
+            [1, 0, 0, 0],
+            [1, 0, 0, 0],
+            [0, 1, 0, 0],
+            [0, 1, 0, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ]
+    )
+
+    parent_pred_matrix = pred_matrix.dot(child_to_parent_matrix)
+    parent_gold_matrix = gold_matrix.dot(child_to_parent_matrix)
+
+    parent_dict = dict(zip(range(4), ["a", "b", "c", "d"]))
+
+    logging.info("Parent-Translated Gold Standard")
+    logging.info(parent_gold_matrix)
+    logging.info("Parent-Translated Prediction")
+    logging.info(parent_pred_matrix)
+
+    logging.info(
+        report(parent_pred_matrix, parent_gold_matrix, parent_dict).to_dataframe()
+    )